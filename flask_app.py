@@ -4,17 +4,29 @@ AWS E-Commerce Platform
 A scalable e-commerce application built for AWS infrastructure
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, g, has_app_context, make_response
+from flask_compress import Compress
 import os
 import boto3
-import mysql.connector
-from mysql.connector import Error
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from mysql.connector import Error, pooling
+from cachetools import TTLCache
 import logging
+import functools
 import json
+import math
+import hashlib
+import queue
+import threading
+import time
 from datetime import datetime
+from types import MappingProxyType
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 import uuid
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(
@@ -27,6 +39,11 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'default-secret-key-change-in-production')
 
+# Compress HTML/JSON responses
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 1024
+Compress(app)
+
 # Configuration
 class Config:
     DB_HOST = os.environ.get('DB_HOST', 'localhost')
@@ -36,83 +53,293 @@ class Config:
     S3_BUCKET = os.environ.get('S3_BUCKET', 'ecommerce-bucket')
     AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
     CLOUDFRONT_DOMAIN = os.environ.get('CLOUDFRONT_DOMAIN', '')
+    APP_VERSION = os.environ.get('APP_VERSION', '')
+
+# AWS clients share one session with pooled keep-alive connections and are
+# created on first use to keep worker startup cheap
+aws_client_config = BotoConfig(
+    max_pool_connections=50,
+    retries={'mode': 'standard', 'max_attempts': 3},
+    tcp_keepalive=True
+)
+_aws_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=1)
+def _get_aws_session():
+    """Shared boto3 session"""
+    return boto3.session.Session(region_name=Config.AWS_REGION)
 
-# Initialize AWS services
-s3_client = boto3.client('s3', region_name=Config.AWS_REGION)
-cloudwatch = boto3.client('cloudwatch', region_name=Config.AWS_REGION)
+@functools.lru_cache(maxsize=1)
+def _get_s3():
+    """S3 client"""
+    # Sessions are not thread-safe for creating clients
+    with _aws_lock:
+        # SigV4 is required for presigned POSTs on newer buckets
+        return _get_aws_session().client(
+            's3', config=aws_client_config.merge(BotoConfig(signature_version='s3v4')))
+
+@functools.lru_cache(maxsize=1)
+def _get_cloudwatch():
+    """CloudWatch client"""
+    with _aws_lock:
+        return _get_aws_session().client('cloudwatch', config=aws_client_config)
+
+# Large uploads go multipart in parallel chunks; small ones use a single PUT
+s3_transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    use_threads=True
+)
 
 class DatabaseManager:
-    """Database connection and operations manager"""
+    """Database connection pool and operations manager"""
+    
+    POOL_SIZE = 20
+    PREPARED_CACHE_SIZE = 32  # prepared statements kept per connection
+    CACHE_SIZE = 64
+    CACHE_TTL = 30  # seconds
     
     def __init__(self):
-        self.connection = None
+        self.pool = None
+        self._lock = threading.Lock()
+        self._cache = TTLCache(maxsize=self.CACHE_SIZE, ttl=self.CACHE_TTL)
+        self._cache_lock = threading.RLock()
     
     def connect(self):
-        """Establish database connection"""
-        try:
-            self.connection = mysql.connector.connect(
-                host=Config.DB_HOST,
-                database=Config.DB_NAME,
-                user=Config.DB_USER,
-                password=Config.DB_PASSWORD,
-                autocommit=True,
-                pool_name='ecommerce_pool',
-                pool_size=10
-            )
-            logger.info("Database connection established successfully")
-            return True
-        except Error as e:
-            logger.error(f"Error connecting to database: {e}")
-            return False
+        """Create the database connection pool"""
+        with self._lock:
+            if self.pool is not None:
+                return True
+            try:
+                self.pool = pooling.MySQLConnectionPool(
+                    pool_name='ecommerce_pool',
+                    pool_size=self.POOL_SIZE,
+                    host=Config.DB_HOST,
+                    database=Config.DB_NAME,
+                    user=Config.DB_USER,
+                    password=Config.DB_PASSWORD,
+                    autocommit=True,
+                    # Use the C extension for faster protocol and row decoding
+                    use_pure=False,
+                    # Keep server-side prepared statements across checkouts
+                    pool_reset_session=False
+                )
+                logger.info("Database connection pool established successfully")
+                return True
+            except Error as e:
+                logger.error(f"Error connecting to database: {e}")
+                return False
+    
+    def _acquire(self):
+        """Borrow a pooled connection, reusing the current request's if any"""
+        if not has_app_context():
+            return self.pool.get_connection()
+        if 'db_conn' not in g:
+            g.db_conn = self.pool.get_connection()
+        return g.db_conn
+    
+    def _release(self, conn, failed=False):
+        """Return a connection to the pool unless the current request still holds it"""
+        if has_app_context() and g.get('db_conn') is conn:
+            if not failed or conn.is_connected():
+                return
+            # Broken connection; let the rest of the request borrow a fresh one
+            g.pop('db_conn')
+        conn.close()
+    
+    def release_request_connection(self, exception=None):
+        """Return the current request's connection to the pool"""
+        conn = g.pop('db_conn', None)
+        if conn is not None:
+            conn.close()
+    
+    def _prepared_cursor(self, conn, query, dictionary=True):
+        """Return a reusable prepared cursor for query on a pooled connection"""
+        cnx = getattr(conn, '_cnx', conn)
+        cursors = getattr(cnx, '_prepared', None)
+        if cursors is None or cnx._prepared_connection_id != cnx.connection_id:
+            # New or reconnected session; statements from the old one are gone
+            cursors = cnx._prepared = OrderedDict()
+            cnx._prepared_connection_id = cnx.connection_id
+        
+        key = (query, dictionary)
+        cursor = cursors.get(key)
+        if cursor is not None:
+            cursors.move_to_end(key)
+            return cursor
+        
+        cursor = cnx.cursor(prepared=True, dictionary=dictionary)
+        cursors[key] = cursor
+        if len(cursors) > self.PREPARED_CACHE_SIZE:
+            _, evicted = cursors.popitem(last=False)
+            evicted.close()
+        return cursor
     
-    def execute_query(self, query, params=None):
-        """Execute a database query"""
+    def _discard_prepared(self, conn):
+        """Drop cached prepared cursors for a pooled connection"""
+        cnx = getattr(conn, '_cnx', conn)
+        for cursor in (getattr(cnx, '_prepared', None) or {}).values():
+            try:
+                cursor.close()
+            except Error:
+                pass
+        cnx._prepared = None
+    
+    def execute_query(self, query, params=None, fetch=None, dictionary=True):
+        """Execute a database query on a pooled connection
+        
+        Within a request all queries share one connection, which is returned
+        to the pool on teardown. Parameterized statements run through prepared
+        cursors cached per connection, so repeat queries skip the server-side
+        parse. fetch=True returns the result rows and fetch=False the
+        affected row count; when omitted it is inferred from the statement.
+        Pass dictionary=False to get plain tuple rows.
+        """
+        if self.pool is None and not self.connect():
+            return None
+        
+        conn = None
+        cursor = None
+        prepared = bool(params)
+        failed = False
         try:
-            cursor = self.connection.cursor(dictionary=True)
+            conn = self._acquire()
+            if prepared:
+                cursor = self._prepared_cursor(conn, query, dictionary)
+            else:
+                cursor = conn.cursor(dictionary=dictionary)
             cursor.execute(query, params or ())
-            if query.strip().upper().startswith('SELECT'):
+            if fetch is None:
+                fetch = query.lstrip()[:6].lower() == 'select'
+            if fetch:
                 result = cursor.fetchall()
             else:
                 result = cursor.rowcount
-            cursor.close()
             return result
         except Error as e:
             logger.error(f"Database query error: {e}")
+            failed = True
+            if prepared and conn is not None:
+                self._discard_prepared(conn)
             return None
+        finally:
+            if cursor is not None and not prepared:
+                cursor.close()
+            if conn is not None:
+                self._release(conn, failed)
+    
+    def execute_cached_query(self, query, params=None, dictionary=True):
+        """Execute a SELECT query, serving repeat calls from a short-lived cache"""
+        key = (query, tuple(params or ()), dictionary)
+        with self._cache_lock:
+            result = self._cache.get(key)
+        if result is not None:
+            return result
+        
+        result = self.execute_query(query, params, fetch=True, dictionary=dictionary)
+        if result is None:
+            return None
+        
+        # Cached rows are shared across requests, so store read-only views
+        if dictionary:
+            result = tuple(MappingProxyType(row) for row in result)
+        else:
+            result = tuple(tuple(row) for row in result)
+        with self._cache_lock:
+            self._cache[key] = result
+        return result
+    
+    def execute_many(self, query, seq_params):
+        """Execute a statement for every parameter set in a single batch"""
+        if self.pool is None and not self.connect():
+            return None
+        
+        conn = None
+        cursor = None
+        failed = False
+        try:
+            conn = self._acquire()
+            cursor = conn.cursor()
+            cursor.executemany(query, seq_params)
+            return cursor.rowcount
+        except Error as e:
+            logger.error(f"Database batch query error: {e}")
+            failed = True
+            return None
+        finally:
+            if cursor is not None:
+                cursor.close()
+            if conn is not None:
+                self._release(conn, failed)
     
     def close(self):
-        """Close database connection"""
-        if self.connection and self.connection.is_connected():
-            self.connection.close()
-            logger.info("Database connection closed")
+        """Close all pooled database connections"""
+        if self.pool is not None:
+            self.pool._remove_connections()
+            self.pool = None
+            logger.info("Database connections closed")
 
 # Initialize database manager
 db = DatabaseManager()
+app.teardown_appcontext(db.release_request_connection)
 
 class MetricsManager:
-    """CloudWatch metrics manager"""
+    """CloudWatch metrics manager
+
+    Metrics are buffered in-process and sent in batches from a background
+    thread so request handlers never wait on PutMetricData.
+    """
+    
+    NAMESPACE = 'ECommerce/Application'
+    MAX_BATCH_SIZE = 20  # CloudWatch limit per PutMetricData call
+    BATCH_INTERVAL = 5  # seconds
     
     @staticmethod
     def put_custom_metric(metric_name, value, unit='Count'):
-        """Send custom metrics to CloudWatch"""
+        """Queue a custom metric for delivery to CloudWatch"""
         try:
-            cloudwatch.put_metric_data(
-                Namespace='ECommerce/Application',
-                MetricData=[
-                    {
-                        'MetricName': metric_name,
-                        'Value': value,
-                        'Unit': unit,
-                        'Timestamp': datetime.utcnow()
-                    }
-                ]
-            )
-        except Exception as e:
-            logger.error(f"Error sending metric to CloudWatch: {e}")
+            metrics_queue.put_nowait({
+                'MetricName': metric_name,
+                'Value': value,
+                'Unit': unit,
+                'Timestamp': datetime.utcnow()
+            })
+        except queue.Full:
+            logger.warning(f"Metrics buffer full, dropping metric {metric_name}")
+    
+    @staticmethod
+    def flush_metrics():
+        """Drain the metrics queue and send batches to CloudWatch"""
+        while True:
+            batch = [metrics_queue.get()]
+            deadline = time.monotonic() + MetricsManager.BATCH_INTERVAL
+            while len(batch) < MetricsManager.MAX_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(metrics_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                _get_cloudwatch().put_metric_data(
+                    Namespace=MetricsManager.NAMESPACE,
+                    MetricData=batch
+                )
+            except Exception as e:
+                logger.error(f"Error sending metrics to CloudWatch: {e}")
+
+# Start background metrics flusher
+metrics_queue = queue.Queue(maxsize=10000)
+threading.Thread(target=MetricsManager.flush_metrics, name='metrics-flusher', daemon=True).start()
 
 class S3Manager:
     """S3 file upload and management"""
     
+    MAX_UPLOAD_SIZE = 20 * 1024 * 1024
+    
     @staticmethod
     def upload_file(file, folder='products'):
         """Upload file to S3 bucket"""
@@ -120,22 +347,97 @@ class S3Manager:
             filename = secure_filename(file.filename)
             key = f"{folder}/{uuid.uuid4()}_{filename}"
             
-            s3_client.upload_fileobj(
+            _get_s3().upload_fileobj(
                 file,
                 Config.S3_BUCKET,
                 key,
-                ExtraArgs={'ContentType': file.content_type}
+                ExtraArgs={'ContentType': file.content_type},
+                Config=s3_transfer_config
             )
             
-            if Config.CLOUDFRONT_DOMAIN:
-                url = f"https://{Config.CLOUDFRONT_DOMAIN}/{key}"
-            else:
-                url = f"https://{Config.S3_BUCKET}.s3.{Config.AWS_REGION}.amazonaws.com/{key}"
-            
-            return url
+            return S3Manager.get_file_url(key)
         except Exception as e:
             logger.error(f"Error uploading file to S3: {e}")
             return None
+    
+    @staticmethod
+    def create_presigned_upload(filename, content_type, folder='products'):
+        """Create a presigned POST so the browser can upload an image directly to S3"""
+        try:
+            key = f"{folder}/{uuid.uuid4()}_{secure_filename(filename)}"
+            
+            return _get_s3().generate_presigned_post(
+                Bucket=Config.S3_BUCKET,
+                Key=key,
+                Fields={'Content-Type': content_type},
+                Conditions=[
+                    ['content-length-range', 0, S3Manager.MAX_UPLOAD_SIZE],
+                    ['starts-with', '$Content-Type', 'image/']
+                ],
+                ExpiresIn=3600
+            )
+        except Exception as e:
+            logger.error(f"Error creating presigned upload: {e}")
+            return None
+    
+    @staticmethod
+    def get_file_metadata(key):
+        """Return S3 object metadata for key, or None if it does not exist"""
+        try:
+            return _get_s3().head_object(Bucket=Config.S3_BUCKET, Key=key)
+        except Exception as e:
+            logger.error(f"Error reading S3 object {key}: {e}")
+            return None
+    
+    @staticmethod
+    def get_file_url(key):
+        """Public URL for an object key, served via CloudFront when configured"""
+        if Config.CLOUDFRONT_DOMAIN:
+            return f"https://{Config.CLOUDFRONT_DOMAIN}/{key}"
+        return f"https://{Config.S3_BUCKET}.s3.{Config.AWS_REGION}.amazonaws.com/{key}"
+
+def format_cents(cents):
+    """Format an integer amount of cents as a decimal price string"""
+    sign = '-' if cents < 0 else ''
+    units, remainder = divmod(abs(cents), 100)
+    return f"{sign}{units}.{remainder:02d}"
+
+@functools.lru_cache(maxsize=1)
+def listing_version():
+    """Release identifier for the product listing markup
+    
+    Combines APP_VERSION with a hash of the products.html source so a deploy
+    that changes the page invalidates cached listings.
+    """
+    source, _, _ = app.jinja_env.loader.get_source(app.jinja_env, 'products.html')
+    return f"{Config.APP_VERSION}:{hashlib.md5(source.encode()).hexdigest()}"
+
+def get_session_cart():
+    """Session cart as an insertion-ordered {product_id: quantity} dict
+    
+    The cookie stores [product_id, quantity] pairs because Flask's session
+    serializer sorts dict keys. Older dict and list-of-dicts carts are read too.
+    """
+    cart = session.get('cart') or []
+    if isinstance(cart, dict):
+        return {int(product_id): quantity for product_id, quantity in cart.items()}
+    
+    items = {}
+    for item in cart:
+        if isinstance(item, dict):
+            items[int(item['id'])] = item['quantity']
+        else:
+            product_id, quantity = item
+            items[int(product_id)] = quantity
+    return items
+
+def cart_to_json(cart):
+    """Encode a cart as a JSON array of [product_id, quantity] pairs for JSON_TABLE"""
+    return json.dumps([[product_id, quantity] for product_id, quantity in cart.items()])
+
+def save_session_cart(cart):
+    """Store a {product_id: quantity} cart in the session, keeping its order"""
+    session['cart'] = [[product_id, quantity] for product_id, quantity in cart.items()]
 
 # Routes
 @app.route('/')
@@ -143,7 +445,7 @@ def index():
     """Home page with featured products"""
     try:
         # Get featured products
-        products = db.execute_query("""
+        products = db.execute_cached_query("""
             SELECT id, name, price, description, image_url 
             FROM products 
             WHERE featured = 1 
@@ -159,16 +461,23 @@ def index():
         logger.error(f"Error loading home page: {e}")
         return render_template('error.html', message="Unable to load products"), 500
 
+# Time of the last successful health check database query
+_last_db_ok_at = 0.0
+_DB_OK_TTL = 5  # seconds
+
 @app.route('/health')
 def health_check():
     """Health check endpoint for load balancer"""
+    global _last_db_ok_at
     try:
-        # Check database connection
-        if not db.connection or not db.connection.is_connected():
-            db.connect()
-        
-        # Simple query to verify database
-        result = db.execute_query("SELECT 1")
+        # Reuse a recent successful check so probes don't hit the database
+        if time.monotonic() - _last_db_ok_at < _DB_OK_TTL:
+            result = True
+        else:
+            # Simple query to verify database
+            result = db.execute_query("SELECT 1", fetch=True, dictionary=False)
+            if result is not None:
+                _last_db_ok_at = time.monotonic()
         
         if result is not None:
             return jsonify({
@@ -197,6 +506,26 @@ def products():
         per_page = 12
         offset = (page - 1) * per_page
         
+        # Send metric
+        MetricsManager.put_custom_metric('ProductPageViews', 1)
+        
+        # Skip the listing query and render when the client's copy is current
+        # Covers all rows so deactivations and deletions change the ETag too
+        etag = None
+        version = db.execute_cached_query(
+            "SELECT MAX(updated_at), COUNT(*) FROM products", dictionary=False)
+        if version:
+            last_updated, product_count = version[0]
+            etag = hashlib.md5(
+                f"{listing_version()}:{page}:{last_updated}:{product_count}".encode()
+            ).hexdigest()
+            # Flask-Compress suffixes the ETag with the content encoding
+            candidates = [etag] + [f"{etag}:{algorithm}" for algorithm in app.config['COMPRESS_ALGORITHM']]
+            if any(request.if_none_match.contains_weak(tag) for tag in candidates):
+                response = make_response('', 304)
+                response.set_etag(etag, weak=True)
+                return response
+        
         # Get products with pagination
         products = db.execute_query("""
             SELECT id, name, price, description, image_url, category
@@ -204,20 +533,22 @@ def products():
             WHERE active = 1
             ORDER BY created_at DESC 
             LIMIT %s OFFSET %s
-        """, (per_page, offset))
-        
-        # Get total count for pagination
-        total_count = db.execute_query("SELECT COUNT(*) as count FROM products WHERE active = 1")
-        total = total_count[0]['count'] if total_count else 0
-        
-        # Send metric
-        MetricsManager.put_custom_metric('ProductPageViews', 1)
-        
-        return render_template('products.html', 
-                             products=products or [], 
-                             page=page, 
-                             total=total,
-                             per_page=per_page)
+        """, (per_page, offset), fetch=True)
+        
+        # Get total count for pagination; it only drives the page links, so
+        # serve it from the short-lived cache
+        total_count = db.execute_cached_query(
+            "SELECT COUNT(*) FROM products WHERE active = 1", dictionary=False)
+        total = total_count[0][0] if total_count else 0
+        
+        response = make_response(render_template('products.html', 
+                                                 products=products or [], 
+                                                 page=page, 
+                                                 total=total,
+                                                 per_page=per_page))
+        if etag:
+            response.set_etag(etag, weak=True)
+        return response
     except Exception as e:
         logger.error(f"Error loading products: {e}")
         return render_template('error.html', message="Unable to load products"), 500
@@ -230,7 +561,7 @@ def product_detail(product_id):
             SELECT id, name, price, description, image_url, category, stock_quantity
             FROM products 
             WHERE id = %s AND active = 1
-        """, (product_id,))
+        """, (product_id,), fetch=True)
         
         if not product:
             return render_template('error.html', message="Product not found"), 404
@@ -241,7 +572,7 @@ def product_detail(product_id):
             FROM products 
             WHERE category = %s AND id != %s AND active = 1
             LIMIT 4
-        """, (product[0]['category'], product_id))
+        """, (product[0]['category'], product_id), fetch=True)
         
         # Send metric
         MetricsManager.put_custom_metric('ProductDetailViews', 1)
@@ -257,29 +588,42 @@ def product_detail(product_id):
 def cart():
     """Shopping cart page"""
     try:
-        cart_items = session.get('cart', [])
-        total = 0
+        cart_items = get_session_cart()
+        items = []
+        total_cents = 0
         
         if cart_items:
-            # Get product details for cart items
-            product_ids = [item['id'] for item in cart_items]
-            placeholders = ','.join(['%s'] * len(product_ids))
+            # Join cart quantities against products so MySQL computes subtotals
+            # as integer cents. The cart is passed as one JSON array so the
+            # statement text is the same for every cart size; ordering by the
+            # array position keeps lines in the order they were added.
+            rows = db.execute_query("""
+                SELECT p.id, p.name, p.price, p.image_url, c.qty AS quantity,
+                       CAST(p.price * 100 AS SIGNED) * c.qty AS subtotal_cents
+                FROM products p
+                JOIN JSON_TABLE(%s, '$[*]' COLUMNS (
+                    seq FOR ORDINALITY,
+                    id INT PATH '$[0]',
+                    qty INT PATH '$[1]'
+                )) c ON p.id = c.id
+                ORDER BY c.seq
+            """, (cart_to_json(cart_items),), fetch=True)
             
-            products = db.execute_query(f"""
-                SELECT id, name, price, image_url
-                FROM products 
-                WHERE id IN ({placeholders})
-            """, product_ids)
+            # Drop products that no longer exist so checkout can't trip on them
+            if rows is not None and len(rows) < len(cart_items):
+                save_session_cart({row['id']: row['quantity'] for row in rows})
             
-            # Calculate total
-            product_dict = {p['id']: p for p in products}
-            for item in cart_items:
-                if item['id'] in product_dict:
-                    item['product'] = product_dict[item['id']]
-                    item['subtotal'] = item['quantity'] * product_dict[item['id']]['price']
-                    total += item['subtotal']
-        
-        return render_template('cart.html', cart_items=cart_items, total=total)
+            for row in rows or []:
+                subtotal_cents = int(row['subtotal_cents'])
+                total_cents += subtotal_cents
+                items.append({
+                    'id': row['id'],
+                    'quantity': row['quantity'],
+                    'product': row,
+                    'subtotal': format_cents(subtotal_cents)
+                })
+        
+        return render_template('cart.html', cart_items=items, total=format_cents(total_cents))
     except Exception as e:
         logger.error(f"Error loading cart: {e}")
         return render_template('error.html', message="Unable to load cart"), 500
@@ -290,13 +634,15 @@ def add_to_cart():
     try:
         product_id = int(request.form.get('product_id'))
         quantity = int(request.form.get('quantity', 1))
+        if quantity < 1:
+            return jsonify({'error': 'Invalid quantity'}), 400
         
         # Verify product exists and is in stock
         product = db.execute_query("""
             SELECT id, name, stock_quantity 
             FROM products 
             WHERE id = %s AND active = 1
-        """, (product_id,))
+        """, (product_id,), fetch=True)
         
         if not product:
             return jsonify({'error': 'Product not found'}), 404
@@ -305,17 +651,9 @@ def add_to_cart():
             return jsonify({'error': 'Insufficient stock'}), 400
         
         # Add to session cart
-        cart = session.get('cart', [])
-        
-        # Check if product already in cart
-        for item in cart:
-            if item['id'] == product_id:
-                item['quantity'] += quantity
-                break
-        else:
-            cart.append({'id': product_id, 'quantity': quantity})
-        
-        session['cart'] = cart
+        cart = get_session_cart()
+        cart[product_id] = cart.get(product_id, 0) + quantity
+        save_session_cart(cart)
         
         # Send metric
         MetricsManager.put_custom_metric('AddToCart', 1)
@@ -329,7 +667,7 @@ def add_to_cart():
 def checkout():
     """Checkout process"""
     if request.method == 'GET':
-        cart_items = session.get('cart', [])
+        cart_items = get_session_cart()
         if not cart_items:
             return redirect(url_for('cart'))
         
@@ -344,7 +682,7 @@ def checkout():
             'phone': request.form.get('phone')
         }
         
-        cart_items = session.get('cart', [])
+        cart_items = get_session_cart()
         if not cart_items:
             return redirect(url_for('cart'))
         
@@ -352,26 +690,43 @@ def checkout():
         order_id = str(uuid.uuid4())
         
         # Insert order
-        db.execute_query("""
+        inserted = db.execute_query("""
             INSERT INTO orders (id, customer_name, customer_email, customer_address, 
-                              customer_phone, status, created_at)
-            VALUES (%s, %s, %s, %s, %s, 'pending', %s)
+                              customer_phone, status)
+            VALUES (%s, %s, %s, %s, %s, 'pending')
         """, (order_id, customer_data['name'], customer_data['email'], 
-              customer_data['address'], customer_data['phone'], datetime.utcnow()))
-        
-        # Insert order items
-        for item in cart_items:
-            db.execute_query("""
-                INSERT INTO order_items (order_id, product_id, quantity, created_at)
-                VALUES (%s, %s, %s, %s)
-            """, (order_id, item['id'], item['quantity'], datetime.utcnow()))
+              customer_data['address'], customer_data['phone']), fetch=False)
+        if inserted is None:
+            return render_template('error.html', message="Unable to process order"), 500
+        
+        # Insert order items in one statement, skipping products that no
+        # longer exist so a stale cart line can't fail the whole order
+        items_inserted = db.execute_query("""
+            INSERT INTO order_items (order_id, product_id, quantity)
+            SELECT %s, p.id, c.qty
+            FROM products p
+            JOIN JSON_TABLE(%s, '$[*]' COLUMNS (
+                id INT PATH '$[0]',
+                qty INT PATH '$[1]'
+            )) c ON p.id = c.id
+        """, (order_id, cart_to_json(cart_items)), fetch=False)
+        if not items_inserted:
+            # Don't fulfil an empty order
+            db.execute_query("UPDATE orders SET status = 'failed' WHERE id = %s",
+                             (order_id,), fetch=False)
+            if items_inserted == 0:
+                # None of the cart's products exist any more
+                session['cart'] = []
+                return render_template('error.html', message="Items in your cart are no longer available"), 400
+            # Keep the cart so the customer can retry
+            return render_template('error.html', message="Unable to process order"), 500
         
         # Clear cart
         session['cart'] = []
         
         # Send metrics
         MetricsManager.put_custom_metric('Orders', 1)
-        MetricsManager.put_custom_metric('OrderValue', sum(item['quantity'] for item in cart_items), 'Count')
+        MetricsManager.put_custom_metric('OrderValue', sum(cart_items.values()), 'Count')
         
         return render_template('order_success.html', order_id=order_id)
         
@@ -386,6 +741,10 @@ def admin_upload():
         return render_template('admin_upload.html')
     
     try:
+        product_data, error = parse_product_data(request.form)
+        if error:
+            return jsonify({'error': error}), 400
+        
         # Upload product image to S3
         if 'image' not in request.files:
             return jsonify({'error': 'No image file'}), 400
@@ -399,23 +758,8 @@ def admin_upload():
         if not image_url:
             return jsonify({'error': 'Failed to upload image'}), 500
         
-        # Insert product into database
-        product_data = {
-            'name': request.form.get('name'),
-            'description': request.form.get('description'),
-            'price': float(request.form.get('price')),
-            'category': request.form.get('category'),
-            'stock_quantity': int(request.form.get('stock_quantity', 0)),
-            'image_url': image_url
-        }
-        
-        db.execute_query("""
-            INSERT INTO products (name, description, price, category, stock_quantity, 
-                                image_url, active, featured, created_at)
-            VALUES (%s, %s, %s, %s, %s, %s, 1, 0, %s)
-        """, (product_data['name'], product_data['description'], product_data['price'],
-              product_data['category'], product_data['stock_quantity'], 
-              product_data['image_url'], datetime.utcnow()))
+        if create_product(product_data, image_url) is None:
+            return jsonify({'error': 'Failed to upload product'}), 500
         
         return jsonify({'success': True, 'message': 'Product uploaded successfully'})
         
@@ -423,26 +767,150 @@ def admin_upload():
         logger.error(f"Error uploading product: {e}")
         return jsonify({'error': 'Failed to upload product'}), 500
 
+# Signs the S3 keys issued by /admin/upload/init
+upload_serializer = URLSafeTimedSerializer(app.secret_key, salt='product-image-upload')
+UPLOAD_TOKEN_MAX_AGE = 3600  # seconds, matches the presigned POST expiry
+
+@app.route('/admin/upload/init', methods=['POST'])
+def admin_upload_init():
+    """Issue a presigned POST for uploading a product image directly to S3"""
+    try:
+        data = request.get_json(silent=True) or request.form
+        
+        # Reject bad product details before the browser uploads anything
+        _, error = parse_product_data(data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        filename = data.get('filename')
+        if not filename or not isinstance(filename, str):
+            return jsonify({'error': 'No file selected'}), 400
+        
+        content_type = data.get('content_type')
+        if not isinstance(content_type, str) or not content_type.startswith('image/'):
+            return jsonify({'error': 'File must be an image'}), 400
+        
+        upload = S3Manager.create_presigned_upload(filename, content_type)
+        if not upload:
+            return jsonify({'error': 'Failed to prepare upload'}), 500
+        
+        return jsonify({
+            'url': upload['url'],
+            'fields': upload['fields'],
+            'key': upload['fields']['key'],
+            # Proves to /admin/upload/complete that this key was issued here
+            'upload_token': upload_serializer.dumps(upload['fields']['key'])
+        })
+    except Exception as e:
+        logger.error(f"Error preparing upload: {e}")
+        return jsonify({'error': 'Failed to prepare upload'}), 500
+
+@app.route('/admin/upload/complete', methods=['POST'])
+def admin_upload_complete():
+    """Record a product whose image the browser has uploaded to S3"""
+    try:
+        data = request.get_json(silent=True) or request.form
+        product_data, error = parse_product_data(data)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        token = data.get('upload_token')
+        if not isinstance(token, str):
+            return jsonify({'error': 'Invalid upload token'}), 400
+        try:
+            key = upload_serializer.loads(token, max_age=UPLOAD_TOKEN_MAX_AGE)
+        except BadSignature:
+            return jsonify({'error': 'Invalid upload token'}), 400
+        
+        # Each token may only create one product
+        image_url = S3Manager.get_file_url(key)
+        existing = db.execute_query(
+            "SELECT 1 FROM products WHERE image_url = %s LIMIT 1", (image_url,), fetch=True)
+        if existing is None:
+            return jsonify({'error': 'Failed to upload product'}), 500
+        if existing:
+            return jsonify({'error': 'Upload token has already been used'}), 409
+        
+        # Confirm the browser actually uploaded an acceptable image
+        metadata = S3Manager.get_file_metadata(key)
+        if metadata is None:
+            return jsonify({'error': 'Image has not been uploaded'}), 400
+        if (metadata['ContentLength'] > S3Manager.MAX_UPLOAD_SIZE
+                or not metadata.get('ContentType', '').startswith('image/')):
+            return jsonify({'error': 'Invalid image file'}), 400
+        
+        if create_product(product_data, image_url) is None:
+            return jsonify({'error': 'Failed to upload product'}), 500
+        
+        return jsonify({'success': True, 'message': 'Product uploaded successfully'})
+    except Exception as e:
+        logger.error(f"Error completing upload: {e}")
+        return jsonify({'error': 'Failed to upload product'}), 500
+
+def parse_product_data(data):
+    """Validate submitted admin product fields
+    
+    Returns (product_data, None) on success or (None, error message).
+    """
+    name = data.get('name')
+    if not name or not isinstance(name, str):
+        return None, 'Product name is required'
+    
+    try:
+        price = float(data.get('price'))
+    except (TypeError, ValueError):
+        return None, 'Invalid price'
+    if not math.isfinite(price) or price < 0:
+        return None, 'Invalid price'
+    
+    try:
+        stock_quantity = int(data.get('stock_quantity', 0))
+    except (TypeError, ValueError):
+        return None, 'Invalid stock quantity'
+    if stock_quantity < 0:
+        return None, 'Invalid stock quantity'
+    
+    return {
+        'name': name,
+        'description': data.get('description'),
+        'price': price,
+        'category': data.get('category'),
+        'stock_quantity': stock_quantity
+    }, None
+
+def create_product(product_data, image_url):
+    """Insert a product from validated admin form data
+    
+    Returns the inserted row count, or None if the insert failed.
+    """
+    return db.execute_query("""
+        INSERT INTO products (name, description, price, category, stock_quantity, 
+                            image_url, active, featured)
+        VALUES (%s, %s, %s, %s, %s, %s, 1, 0)
+    """, (product_data['name'], product_data['description'], product_data['price'],
+          product_data['category'], product_data['stock_quantity'], 
+          image_url), fetch=False)
+
 @app.route('/api/metrics')
 def api_metrics():
     """API endpoint for application metrics"""
     try:
         metrics = {
             'timestamp': datetime.utcnow().isoformat(),
-            'database_status': 'connected' if db.connection and db.connection.is_connected() else 'disconnected',
+            'database_status': 'disconnected',
             'total_products': 0,
             'total_orders': 0
         }
         
-        # Get product count
-        product_count = db.execute_query("SELECT COUNT(*) as count FROM products WHERE active = 1")
-        if product_count:
-            metrics['total_products'] = product_count[0]['count']
-        
-        # Get order count
-        order_count = db.execute_query("SELECT COUNT(*) as count FROM orders")
-        if order_count:
-            metrics['total_orders'] = order_count[0]['count']
+        # Get product and order counts in one query
+        counts = db.execute_cached_query("""
+            SELECT (SELECT COUNT(*) FROM products WHERE active = 1) AS total_products,
+                   (SELECT COUNT(*) FROM orders) AS total_orders
+        """, dictionary=False)
+        if counts is not None:
+            metrics['database_status'] = 'connected'
+        if counts:
+            metrics['total_products'], metrics['total_orders'] = counts[0]
         
         return jsonify(metrics)
     except Exception as e:
@@ -507,7 +975,23 @@ def init_database():
         ]
         
         for table_sql in tables:
-            db.execute_query(table_sql)
+            db.execute_query(table_sql, fetch=False)
+        
+        # Create indexes for the listing and related-products queries.
+        # order_items(order_id) is already indexed by its foreign key.
+        indexes = [
+            ('products', 'idx_products_active_created', 'active, created_at DESC'),
+            ('products', 'idx_products_category_active', 'category, active')
+        ]
+        
+        for table, index_name, columns in indexes:
+            existing = db.execute_query("""
+                SELECT 1 FROM information_schema.statistics
+                WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+                LIMIT 1
+            """, (table, index_name), fetch=True)
+            if existing is not None and not existing:
+                db.execute_query(f"CREATE INDEX {index_name} ON {table} ({columns})", fetch=False)
         
         logger.info("Database initialized successfully")
         